@@ -1,7 +1,24 @@
 import re
 
 
+# Every line boundary str.splitlines() recognises
+line_break_pattern = re.compile("\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+
+# Yields the lines of raw one at a time rather than building a list of
+# all of them, splitting exactly where str.splitlines() would.
+def iter_lines(raw):
+    start = 0
+    for match in line_break_pattern.finditer(raw):
+        yield raw[start:match.start()]
+        start = match.end()
+    if start < len(raw):
+        yield raw[start:]
+
+
 class Tag:
+    __slots__ = ("pattern", "description", "on_open", "on_close")
+
     def __init__(self, pattern, description, on_open, on_close):
         self.pattern = pattern
         self.description = description
@@ -37,26 +54,39 @@ class TagAdapter:
         ),
     ]
 
+    # All tag patterns fused into a single alternation, tried in md_tags
+    # order, so each line takes one pass through the regex engine instead
+    # of one per tag.  Each alternative keeps exactly one (unnamed) body
+    # group, so group n belongs to md_tags[n - 1].
+    md_pattern = re.compile("|".join(
+        "(?:{})".format(tag.pattern.pattern.replace("(?P<body>", "("))
+        for tag in md_tags
+    ))
+
+    # Leading characters of every md_tags pattern.  Lines starting with
+    # anything else are plain text and skip the regex engine entirely.
+    md_prefixes = ("#", "*", "~")
+
     def __init__(self, printer):
         self.printer = printer
 
-    @staticmethod
-    def tag_match(line):
-        matches = (
-            (tag, tag.pattern.match(line))
-            for tag in TagAdapter.md_tags
-        )
-        return next(((tag, match) for (tag, match) in matches if match is not None), None)
-
     def print(self, raw):
-        for line in raw.splitlines():
-            match_pair = TagAdapter.tag_match(line)
-            if match_pair is not None:
-                tag, match = match_pair
-                tag.on_open(self.printer)
-                self.printer.print(match.group("body"))
-                self.printer.print("\n")
-                tag.on_close(self.printer)
+        printer = self.printer
+        if not any(prefix in raw for prefix in TagAdapter.md_prefixes):
+            # No tags anywhere, so every line is plain text
+            for line in iter_lines(raw):
+                printer.print(line + "\n")
+            return
+        for line in iter_lines(raw):
+            match = None
+            if line.startswith(TagAdapter.md_prefixes):
+                match = TagAdapter.md_pattern.match(line)
+            if match is not None:
+                tag = TagAdapter.md_tags[match.lastindex - 1]
+                tag.on_open(printer)
+                printer.print(match.group(match.lastindex))
+                printer.print("\n")
+                tag.on_close(printer)
             else:
-                self.printer.print(line)
-                self.printer.print("\n")
+                printer.print(line)
+                printer.print("\n")
@@ -1,6 +1,8 @@
+import array
 import math
 import sys
 import time
+from contextlib import contextmanager
 
 from PIL import Image
 from serial import Serial
@@ -50,6 +52,7 @@ class ThermalPrinter(Serial):
             self.byte_time = 11.0 / float(baudrate)
 
             Serial.__init__(self, *args, **kwargs)
+            self.set_low_latency()
 
             # Remainder of this method was previously in begin()
 
@@ -119,13 +122,36 @@ class ThermalPrinter(Serial):
     # physically completes the task.
 
     # Sets estimated completion time for a just-issued task.
+    # Uses the monotonic clock so wall-clock adjustments (e.g. NTP
+    # syncing after the Pi boots) can't stretch or skip a wait.
     def timeout_set(self, x):
-        self.resume_time = time.time() + x
+        self.resume_time = time.monotonic() + x
 
-    # Waits (if necessary) for the prior task to complete.
+    # Waits (if necessary) for the prior task to complete.  Sleeps
+    # rather than spinning so the CPU is free while paper moves.
     def timeout_wait(self):
         if self.write_to_stdout is False:
-            while (time.time() - self.resume_time) < 0: pass
+            delay = self.resume_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    # Sets the Linux ASYNC_LOW_LATENCY flag on the port.  USB serial
+    # adapters (FTDI and friends) otherwise hold outgoing data for up
+    # to 16 ms before sending it.  The serial core accepts the flag
+    # for any port, so on the default /dev/serial0 (the Pi's UART)
+    # the ioctls succeed and the port's flags are changed too.  Only
+    # hosts without TIOCGSERIAL/TIOCSSERIAL (non-Linux) or drivers
+    # that reject the ioctls skip it, silently.
+    def set_low_latency(self):
+        try:
+            import fcntl
+            import termios
+            buf = array.array('i', [0] * 32)
+            fcntl.ioctl(self.fd, termios.TIOCGSERIAL, buf)
+            buf[4] |= 0x2000  # ASYNC_LOW_LATENCY in serial_struct.flags
+            fcntl.ioctl(self.fd, termios.TIOCSSERIAL, buf)
+        except (ImportError, AttributeError, IOError):
+            pass
 
     # Printer performance may vary based on the power supply voltage,
     # thickness of paper, phase of the moon and other seemingly random
@@ -144,50 +170,79 @@ class ThermalPrinter(Serial):
         self.dot_print_time = p / 1000000.0
         self.dot_feed_time = f / 1000000.0
 
-    # 'Raw' byte-writing method
+    # Prebuilt fixed command sequences, sent with write_raw()
+    # rather than rebuilt from byte values on every call
+    CMD_RESET = b'\x1b@'  # Esc @ = init command
+    CMD_FLUSH = b'\x0c'  # ASCII FF
+    CMD_ONLINE = b'\x1b=\x01'
+    CMD_OFFLINE = b'\x1b=\x00'
+    CMD_INVERSE_ON = b'\x1dB\x01'
+    CMD_INVERSE_OFF = b'\x1dB\x00'
+    CMD_UNDERLINE_OFF = b'\x1b-\x00'
+
+    # 'Raw' byte-writing method.  Each call is one write with one
+    # timeout wait, so pass a whole command (or a run of commands
+    # that always go together) in a single call rather than
+    # splitting it across several.
     def write_bytes(self, *args):
+        self.write_raw(bytes(args))
+
+    # Sends a bytes object as a single write, e.g. a whole command
+    # or a prebuilt CMD_* sequence.  No text or column tracking.
+    def write_raw(self, data):
         if self.write_to_stdout:
-            for arg in args:
-                sys.stdout.write(str(arg))
+            sys.stdout.buffer.write(data)
         else:
             self.timeout_wait()
-            self.timeout_set(len(args) * self.byte_time)
-            for arg in args:
-                super(ThermalPrinter, self).write(bytes([arg]))
+            self.timeout_set(len(data) * self.byte_time)
+            super(ThermalPrinter, self).write(data)
 
     # Override write() method to keep track of paper feed.
+    # Text is sent one line at a time: each line (up to and including
+    # its newline or wrap point) is encoded and written in one burst,
+    # and the timeout is set from that line's estimated print time.
     def write(self, data):
-        for i in range(len(data)):
-            c = data[i]
-            if self.write_to_stdout:
-                sys.stdout.write(str(c))
-                continue
-            if ord(c) != 0x13:
-                self.timeout_wait()
-                super(ThermalPrinter, self).write(c.encode('cp437', 'ignore'))
-                d = self.byte_time
-                if ((c == '\n') or
-                        (self.column == self.max_column)):
-                    # Newline or wrap
-                    if self.prev_byte == '\n':
-                        # Feed line (blank)
-                        d += ((self.char_height +
-                               self.line_spacing) *
-                              self.dot_feed_time)
-                    else:
-                        # Text line
-                        d += ((self.char_height *
-                               self.dot_print_time) +
-                              (self.line_spacing *
-                               self.dot_feed_time))
-                        self.column = 0
-                        # Treat wrap as newline
-                        # on next pass
-                        c = '\n'
+        if self.write_to_stdout:
+            sys.stdout.buffer.write(data.encode('cp437', 'ignore'))
+            return
+        data = data.replace('\x13', '')
+        start = 0
+        d = 0.0
+        for i, c in enumerate(data):
+            d += self.byte_time
+            if ((c == '\n') or
+                    (self.column == self.max_column)):
+                # Newline or wrap
+                if self.prev_byte == '\n':
+                    # Feed line (blank)
+                    d += ((self.char_height +
+                           self.line_spacing) *
+                          self.dot_feed_time)
                 else:
-                    self.column += 1
-                self.timeout_set(d)
-                self.prev_byte = c
+                    # Text line
+                    d += ((self.char_height *
+                           self.dot_print_time) +
+                          (self.line_spacing *
+                           self.dot_feed_time))
+                    self.column = 0
+                    # Treat wrap as newline
+                    # on next pass
+                    c = '\n'
+                self._write_text(data[start:i + 1], d)
+                start = i + 1
+                d = 0.0
+            else:
+                self.column += 1
+            self.prev_byte = c
+        if start < len(data):
+            self._write_text(data[start:], d)
+
+    # Sends an already-tracked run of text and sets the timeout to
+    # its estimated completion time.
+    def _write_text(self, text, d):
+        self.timeout_wait()
+        super(ThermalPrinter, self).write(text.encode('cp437', 'ignore'))
+        self.timeout_set(d)
 
     # The bulk of this method was moved into __init__,
     # but this is left here for compatibility with older
@@ -201,7 +256,7 @@ class ThermalPrinter(Serial):
             40)  # Heat interval
 
     def reset(self):
-        self.write_bytes(27, 64)  # Esc @ = init command
+        self.write_raw(self.CMD_RESET)
         self.prev_byte = '\n'  # Treat as if prior line is blank
         self.column = 0
         self.max_column = 32
@@ -210,9 +265,10 @@ class ThermalPrinter(Serial):
         self.barcode_height = 50
         if self.firmware_version >= 264:
             # Configure tab stops on recent printers
-            self.write_bytes(27, 68)  # Set tab stops
-            self.write_bytes(4, 8, 12, 16)  # every 4 columns,
-            self.write_bytes(20, 24, 28, 0)  # 0 is end-of-list.
+            self.write_bytes(
+                27, 68,  # Set tab stops
+                4, 8, 12, 16,  # every 4 columns,
+                20, 24, 28, 0)  # 0 is end-of-list.
 
     # Reset text formatting parameters.
     def set_default(self):
@@ -257,43 +313,44 @@ class ThermalPrinter(Serial):
     ITF = 11
     CODABAR = 12
 
-    def print_barcode(self, text, type):
-
-        new_dict = {  # UPC codes & values for firmwareVersion >= 264
-            self.UPC_A: 65,
-            self.UPC_E: 66,
-            self.EAN13: 67,
-            self.EAN8: 68,
-            self.CODE39: 69,
-            self.ITF: 70,
-            self.CODABAR: 71,
-            self.CODE93: 72,
-            self.CODE128: 73,
-            self.I25: -1,  # NOT IN NEW FIRMWARE
-            self.CODEBAR: -1,
-            self.CODE11: -1,
-            self.MSI: -1
-        }
-        old_dict = {  # UPC codes & values for firmwareVersion < 264
-            self.UPC_A: 0,
-            self.UPC_E: 1,
-            self.EAN13: 2,
-            self.EAN8: 3,
-            self.CODE39: 4,
-            self.I25: 5,
-            self.CODEBAR: 6,
-            self.CODE93: 7,
-            self.CODE128: 8,
-            self.CODE11: 9,
-            self.MSI: 10,
-            self.ITF: -1,  # NOT IN OLD FIRMWARE
-            self.CODABAR: -1
-        }
+    # Barcode type values, built once at class load rather than on
+    # every print_barcode() call.  -1 marks types the firmware lacks.
+    barcode_types_new = {  # UPC codes & values for firmwareVersion >= 264
+        UPC_A: 65,
+        UPC_E: 66,
+        EAN13: 67,
+        EAN8: 68,
+        CODE39: 69,
+        ITF: 70,
+        CODABAR: 71,
+        CODE93: 72,
+        CODE128: 73,
+        I25: -1,  # NOT IN NEW FIRMWARE
+        CODEBAR: -1,
+        CODE11: -1,
+        MSI: -1
+    }
+    barcode_types_old = {  # UPC codes & values for firmwareVersion < 264
+        UPC_A: 0,
+        UPC_E: 1,
+        EAN13: 2,
+        EAN8: 3,
+        CODE39: 4,
+        I25: 5,
+        CODEBAR: 6,
+        CODE93: 7,
+        CODE128: 8,
+        CODE11: 9,
+        MSI: 10,
+        ITF: -1,  # NOT IN OLD FIRMWARE
+        CODABAR: -1
+    }
 
+    def print_barcode(self, text, type):
         if self.firmware_version >= 264:
-            n = new_dict[type]
+            n = self.barcode_types_new[type]
         else:
-            n = old_dict[type]
+            n = self.barcode_types_old[type]
         if n == -1:
             return
         self.feed(1)  # Recent firmware requires this?
@@ -304,25 +361,15 @@ class ThermalPrinter(Serial):
         self.timeout_wait()
         self.timeout_set((self.barcode_height + 40) * self.dot_print_time)
         # Print string
+        data = text.encode("utf-8", "ignore")
         if self.firmware_version >= 264:
             # Recent firmware: write length byte + string sans NUL
-            n = len(text)
-            if n > 255: n = 255
-            if self.write_to_stdout:
-                sys.stdout.write(str(n))
-                for i in range(n):
-                    sys.stdout.write(str(text[i]))
-            else:
-                super(ThermalPrinter, self).write(n)
-                for i in range(n):
-                    super(ThermalPrinter,
-                          self).write(text[i])
+            data = data[:255]
+            data = bytes((len(data),)) + data
+        if self.write_to_stdout:
+            sys.stdout.buffer.write(data)
         else:
-            # Older firmware: write string + NUL
-            if self.write_to_stdout:
-                sys.stdout.write(str(text))
-            else:
-                super(ThermalPrinter, self).write(text.encode("utf-8", "ignore"))
+            super(ThermalPrinter, self).write(data)
         self.prev_byte = '\n'
 
     # === Character commands ===
@@ -335,20 +382,34 @@ class ThermalPrinter(Serial):
     STRIKE_MASK = (1 << 6)
 
     def set_print_mode(self, mask):
-        self.print_mode |= mask
-        self.write_print_mode()
-        if self.print_mode & self.DOUBLE_HEIGHT_MASK:
-            self.char_height = 48
-        else:
-            self.char_height = 24
-        if self.print_mode & self.DOUBLE_WIDTH_MASK:
-            self.max_column = 16
-        else:
-            self.max_column = 32
+        self.update_print_mode(set_mask=mask)
 
     def unset_print_mode(self, mask):
-        self.print_mode &= ~mask
+        self.update_print_mode(clear_mask=mask)
+
+    # Sets and clears any number of mode bits with a single ESC !
+    # command, e.g. update_print_mode(BOLD_MASK | DOUBLE_HEIGHT_MASK)
+    # instead of calling bold_on() then double_height_on().
+    def update_print_mode(self, set_mask=0, clear_mask=0):
+        self.print_mode = (self.print_mode | set_mask) & ~clear_mask
         self.write_print_mode()
+        self._apply_mode_geometry()
+
+    # Applies the given mode bits for the duration of a with block,
+    # then restores the previous mode, one ESC ! command each way:
+    #     with printer.print_modes(printer.BOLD_MASK | printer.STRIKE_MASK):
+    #         printer.print("...")
+    @contextmanager
+    def print_modes(self, mask):
+        prev_mode = self.print_mode
+        self.update_print_mode(set_mask=mask)
+        try:
+            yield self
+        finally:
+            self.update_print_mode(set_mask=prev_mode, clear_mask=~prev_mode)
+
+    # Updates char height and line width to match print_mode
+    def _apply_mode_geometry(self):
         if self.print_mode & self.DOUBLE_HEIGHT_MASK:
             self.char_height = 48
         else:
@@ -367,13 +428,13 @@ class ThermalPrinter(Serial):
 
     def inverse_on(self):
         if self.firmware_version >= 268:
-            self.write_bytes(29, 66, 1)
+            self.write_raw(self.CMD_INVERSE_ON)
         else:
             self.set_print_mode(self.INVERSE_MASK)
 
     def inverse_off(self):
         if self.firmware_version >= 268:
-            self.write_bytes(29, 66, 0)
+            self.write_raw(self.CMD_INVERSE_OFF)
         else:
             self.unset_print_mode(self.INVERSE_MASK)
 
@@ -417,20 +478,44 @@ class ThermalPrinter(Serial):
             pos = 0
         self.write_bytes(0x1B, 0x61, pos)
 
+    # Print time of a text line still waiting for its newline.  Feed
+    # commands print it first, so budget it as write() would have.
+    def _pending_line_time(self):
+        if self.prev_byte == '\n':
+            return 0.0
+        return ((self.char_height * self.dot_print_time) +
+                (self.line_spacing * self.dot_feed_time))
+
     # Feeds by the specified number of lines
     def feed(self, x=1):
         if self.firmware_version >= 264:
+            pending = self._pending_line_time()
             self.write_bytes(27, 100, x)
-            self.timeout_set(self.dot_feed_time * self.char_height)
+            # Budget any pending text line plus the full distance fed,
+            # as write() would for x blank lines
+            self.timeout_set(pending +
+                             x * (self.char_height + self.line_spacing) *
+                             self.dot_feed_time)
             self.prev_byte = '\n'
             self.column = 0
 
         else:
             # datasheet claims sending bytes 27, 100, <x> works,
-            # but it feeds much more than that.  So, manually:
-            while x > 0:
-                self.write('\n')
-                x -= 1
+            # but it feeds much more than that.  So feed the same
+            # distance as x lines in pixel rows instead, which
+            # takes one command rather than one write per line.
+            # ESC J takes at most 255 rows per command.
+            # The first command also prints any pending text line, so
+            # its timeout includes that line's print time.
+            pending = self._pending_line_time()
+            rows = x * (self.char_height + self.line_spacing)
+            while rows > 0:
+                step = min(rows, 255)
+                self.feed_rows(step)
+                if pending:
+                    self.timeout_set(pending + step * self.dot_feed_time)
+                    pending = 0.0
+                rows -= step
 
     # Feeds by the specified number of individual pixel rows
     def feed_rows(self, rows):
@@ -440,25 +525,21 @@ class ThermalPrinter(Serial):
         self.column = 0
 
     def flush(self):
-        self.write_bytes(12)  # ASCII FF
+        self.write_raw(self.CMD_FLUSH)
+
+    # Size code, char height and max column for each text size
+    text_sizes = {
+        'L': (0x11, 48, 16),  # Large: double width and height
+        'M': (0x01, 48, 32),  # Medium: double height
+        'S': (0x00, 24, 32),  # Small: standard width and height
+    }
 
     def set_size(self, value):
-        c = value.upper()
-        if c == 'L':  # Large: double width and height
-            size = 0x11
-            self.char_height = 48
-            self.max_column = 16
-        elif c == 'M':  # Medium: double height
-            size = 0x01
-            self.char_height = 48
-            self.max_column = 32
-        else:  # Small: standard width and height
-            size = 0x00
-            self.char_height = 24
-            self.max_column = 32
+        size, self.char_height, self.max_column = self.text_sizes.get(
+            value.upper(), self.text_sizes['S'])
 
         self.write_bytes(29, 33, size)
-        prevByte = '\n'  # Setting the size adds a linefeed
+        self.prev_byte = '\n'  # Setting the size adds a linefeed
 
     # Underlines of different weights can be produced:
     # 0 - no underline
@@ -470,7 +551,7 @@ class ThermalPrinter(Serial):
         self.write_bytes(27, 45, weight)
 
     def underline_off(self):
-        self.write_bytes(27, 45, 0)
+        self.write_raw(self.CMD_UNDERLINE_OFF)
 
     def print_bitmap(self, w, h, bitmap, laa_t=False):
         row_bytes = math.floor((w + 7) / 8)  # Round up to next byte boundary
@@ -490,25 +571,33 @@ class ThermalPrinter(Serial):
         else:
             max_chunk_height = 255
 
+        # Slice rows out of bytes-like bitmaps (e.g. from print_image)
+        # without copying them.  Other sequences of ints, such as the
+        # lists used by the Arduino-port examples, are converted once.
+        try:
+            bitmap = memoryview(bitmap)
+        except TypeError:
+            bitmap = memoryview(bytes(bitmap))
         i = 0
         for rowStart in range(0, h, max_chunk_height):
             chunk_height = h - rowStart
             if chunk_height > max_chunk_height:
                 chunk_height = max_chunk_height
 
-            # Timeout wait happens here
-            self.write_bytes(18, 42, chunk_height, row_bytes_clipped)
-
-            for y in range(chunk_height):
-                for x in range(row_bytes_clipped):
-                    if self.write_to_stdout:
-                        sys.stdout.write(str(bitmap[i]))
-                    else:
-                        super(ThermalPrinter,
-                              self).write(bytes([bitmap[i]]))
-                    i += 1
-                i += row_bytes - row_bytes_clipped
-            self.timeout_set(chunk_height * self.dot_print_time)
+            if row_bytes == row_bytes_clipped:
+                payload = bitmap[i:i + chunk_height * row_bytes]
+            else:
+                payload = b''.join(
+                    bitmap[n:n + row_bytes_clipped]
+                    for n in range(i, i + chunk_height * row_bytes, row_bytes))
+            i += chunk_height * row_bytes
+
+            # Header and all scanlines of the chunk go out in
+            # a single write
+            data = bytes((18, 42, chunk_height, row_bytes_clipped)) + payload
+            self.write_raw(data)
+            self.timeout_set(len(data) * self.byte_time +
+                             chunk_height * self.dot_print_time)
 
         self.prev_byte = '\n'
 
@@ -534,34 +623,21 @@ class ThermalPrinter(Serial):
         height = math.floor(width * aspect)
         image = image.resize((width, height))
 
-        row_bytes = (width + 7) // 8
-        bitmap = bytearray(row_bytes * height)
-        pixels = image.load()
-
-        for y in range(height):
-            n = y * row_bytes
-            x = 0
-            for b in range(row_bytes):
-                sum = 0
-                bit = 128
-                while bit > 0:
-                    if x >= width: break
-                    if pixels[x, y] == 0:
-                        sum |= bit
-                    x += 1
-                    bit >>= 1
-                bitmap[n + b] = sum
+        # Pack to 1 bit per pixel, MSB first, rows padded to a whole
+        # byte.  The inverted "1;I" raw mode sets a bit for each black
+        # (0) pixel, which is what the printer expects.
+        bitmap = image.tobytes("raw", "1;I")
 
         self.print_bitmap(width, height, bitmap, laa_t)
 
     # Take the printer offline. Print commands sent after this
     # will be ignored until 'online' is called.
     def offline(self):
-        self.write_bytes(27, 61, 0)
+        self.write_raw(self.CMD_OFFLINE)
 
     # Take the printer online. Subsequent print commands will be obeyed.
     def online(self):
-        self.write_bytes(27, 61, 1)
+        self.write_raw(self.CMD_ONLINE)
 
     # Put the printer into a low-energy state immediately.
     def sleep(self):
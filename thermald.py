@@ -1,34 +1,69 @@
 #!/usr/bin/python
 
 import argparse
+import logging
 import os
+import signal
+import sys
 import time
-from functools import wraps
+from contextlib import suppress
+from functools import partial, wraps
 from http import HTTPStatus
-from io import BytesIO
-from queue import Queue
-from threading import Thread
+from queue import SimpleQueue
+from threading import Event, Thread
 from uuid import uuid4
 
 import requests
 import waitress
 from PIL import Image
-from flask import Flask, request
+from flask import Flask, jsonify, request
 from flask_cors import CORS
+from serial import SerialException
 
 from adapters.tagadapter import TagAdapter
 from adathermal import ThermalPrinter
 
+log = logging.getLogger("thermald")
+
 app = Flask(__name__)
+# Tasks allowed to wait for the printer before new ones are refused
+app.config["PRINT_QUEUE_SIZE"] = 32
+# Largest /print request accepted; a receipt is a few KB at most
+app.config["MAX_PRINT_BODY"] = 64 * 1024
 
 CORS(app)
 
-print_queue = Queue()
+print_queue = SimpleQueue()
 
 stop_sentinel = object()
+# Set on shutdown to cut short a reconnect backoff
+stop_event = Event()
+
+print_formats = frozenset(("plain", "tag"))
+
+# Seconds the printer can sit idle before the link is re-checked
+# ahead of the next task
+probe_idle_seconds = 30
+
+# Seconds to wait for an image server to connect or send data
+image_fetch_timeout_seconds = 10
+
+# Seconds to wait on shutdown for queued tasks to finish printing
+shutdown_timeout_seconds = 30
+
+# Upper bound on the wait between reconnect attempts
+max_reconnect_backoff_seconds = 30
+
+
+# Raised by task handlers for tasks that can never print (e.g. a
+# corrupt image), as opposed to printer failures
+class BadTaskError(Exception):
+    pass
 
 
 class PrintTask:
+    __slots__ = ("format_type", "body")
+
     def __init__(self, format_type, body):
         self.format_type = format_type
         self.body = body
@@ -47,25 +82,54 @@ def requires_auth():
     return wrapper
 
 
+def requires_queue_space():
+    def wrapper(f):
+        @wraps(f)
+        def wrapped(*wargs, **kwargs):
+            # The printer manages ~2 KB/s, so past a certain backlog new
+            # tasks wouldn't print for minutes; refuse them up front.
+            # Concurrent requests may overshoot the limit slightly.
+            if print_queue.qsize() >= app.config["PRINT_QUEUE_SIZE"]:
+                return "Print queue is full", HTTPStatus.SERVICE_UNAVAILABLE
+            return f(*wargs, **kwargs)
+
+        return wrapped
+
+    return wrapper
+
+
 @app.route("/", methods=["GET"])
 @requires_auth()
 def index():
     return ""
 
 
+@app.route("/queue", methods=["GET"])
+@requires_auth()
+def queue_status():
+    return jsonify(size=print_queue.qsize(), max_size=app.config["PRINT_QUEUE_SIZE"])
+
+
 @app.route("/print", methods=["POST"])
 @requires_auth()
+@requires_queue_space()
 def add_print_task():
-    format_type = request.json.get("format", "tag")
-    if format_type not in ["plain", "tag"]:
+    if (request.content_length or 0) > app.config["MAX_PRINT_BODY"]:
+        return "Body too large", HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("body"), str):
+        return "Expected a JSON object with a string `body`", HTTPStatus.BAD_REQUEST
+    format_type = data.get("format", "tag")
+    if not isinstance(format_type, str) or format_type not in print_formats:
         return "Bad format", HTTPStatus.BAD_REQUEST
-    body = request.json["body"]
+    body = data["body"]
     print_queue.put(PrintTask(format_type, body))
     return "OK"
 
 
 @app.route("/print-image", methods=["POST"])
 @requires_auth()
+@requires_queue_space()
 def add_image_print_task():
     if 'file' not in request.files:
         return "Missing `file`", HTTPStatus.BAD_REQUEST
@@ -77,10 +141,37 @@ def add_image_print_task():
 
 @app.route("/print-image-url", methods=["POST"])
 @requires_auth()
+@requires_queue_space()
 def add_image_print_url_task():
-    image_url = request.json.get("url")
-    image_data = requests.get(image_url).content
-    print_queue.put(PrintTask("image-data", BytesIO(image_data)))
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("url"), str):
+        return "Expected a JSON object with a string `url`", HTTPStatus.BAD_REQUEST
+    image_url = data["url"]
+    path = "/tmp/{}".format(uuid4())
+    # Spool the download to disk in chunks rather than holding the
+    # whole image in memory, then print it like an uploaded file
+    try:
+        response = requests.get(image_url, stream=True, timeout=image_fetch_timeout_seconds)
+    except (requests.exceptions.MissingSchema,
+            requests.exceptions.InvalidSchema,
+            requests.exceptions.InvalidURL) as e:
+        return "Bad `url`: {}".format(e), HTTPStatus.BAD_REQUEST
+    except requests.RequestException as e:
+        return "Failed to fetch image: {}".format(e), HTTPStatus.BAD_GATEWAY
+    with response:
+        if not response.ok:
+            return "Failed to fetch image", HTTPStatus.BAD_GATEWAY
+        try:
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+        except requests.RequestException as e:
+            discard_file(path)
+            return "Failed to fetch image: {}".format(e), HTTPStatus.BAD_GATEWAY
+        except IOError:
+            discard_file(path)
+            raise
+    print_queue.put(PrintTask("image-file", path))
     return "OK"
 
 
@@ -91,47 +182,127 @@ def create_printer(args):
         return ThermalPrinter()
 
 
-def print_loop(args):
-    printer = create_printer(args)
-    tag_adapter = TagAdapter(printer)
+# Releases the serial port before it's reopened on reconnect
+def close_printer(printer):
+    if not printer.write_to_stdout:
+        with suppress(IOError):
+            printer.close()
 
-    while True:
-        try:
-            # Attempt a write to verify that printer is connected
-            printer.set_size('S')
-        except IOError as e:
-            print("Failed to connect to printer: {}".format(e))
-            time.sleep(1)
-            printer = create_printer(args)
-            continue
 
+def discard_file(path):
+    with suppress(FileNotFoundError):
+        os.remove(path)
+
+
+def print_image_file(printer, path):
+    try:
+        # Decode fully before touching the printer, so a file that
+        # isn't a valid image is reported as a bad task rather than
+        # surfacing mid-print as an IOError
         try:
+            image = Image.open(path)
+            image.load()
+        except (IOError, SyntaxError, ValueError,
+                Image.DecompressionBombError) as e:
+            raise BadTaskError("Unreadable image: {}".format(e))
+        printer.print_image(image)
+    finally:
+        discard_file(path)
+
+
+def print_loop(args):
+    printer = None
+    task = None
+    last_ok = 0.0
+    backoff = 1
+
+    while True:
+        if printer is None:
+            # Constructing the printer writes its init sequence, so it
+            # doubles as the connectivity check
+            try:
+                printer = create_printer(args)
+            except IOError as e:
+                log.warning("Failed to connect to printer: %s (retrying in %ss)", e, backoff)
+                # Back off while the printer stays away, but wake at
+                # once if we're shutting down
+                if stop_event.wait(backoff):
+                    break
+                backoff = min(backoff * 2, max_reconnect_backoff_seconds)
+                continue
+            backoff = 1
+            # Task format -> callable that prints a task body
+            handlers = {
+                "plain": printer.print,
+                "tag": TagAdapter(printer).print,
+                "image-file": partial(print_image_file, printer),
+            }
+            last_ok = time.monotonic()
+
+        if task is None:
             task = print_queue.get()
             if task is stop_sentinel:
                 break
-            if task.format_type == "tag":
-                tag_adapter.print(task.body)
-            elif task.format_type == "image-file":
-                printer.print_image(Image.open(task.body))
-                os.remove(task.body)
-            elif task.format_type == "image-data":
-                printer.print_image(Image.open(task.body))
-            else:
-                printer.print(task.body)
-            printer.print("\n" * 3)
-            print_queue.task_done()
+
+        if time.monotonic() - last_ok > probe_idle_seconds:
+            # The printer may have gone away while idle; check before
+            # starting the task so it's kept for retry rather than
+            # lost half-printed
+            try:
+                printer.set_size('S')
+            except SerialException as e:
+                log.warning("Failed to connect to printer: %s", e)
+                close_printer(printer)
+                printer = None
+                continue
+
+        try:
+            handlers[task.format_type](task.body)
+            printer.feed(3)
+            last_ok = time.monotonic()
+        except BadTaskError as e:
+            log.warning("Skipping task: %s", e)
+        except SerialException as e:
+            log.warning("Lost printer while printing task: %s", e)
+            # Reconnect before taking the next task
+            close_printer(printer)
+            printer = None
         except IOError as e:
-            print("Failed to print task: {}".format(e))
+            # Not a serial failure (e.g. a file error), so the printer
+            # is still usable
+            log.warning("Failed to print task: %s", e)
+        except Exception:
+            # Anything else is a bug in a handler; skip the task rather
+            # than let the print thread die with the queue still open
+            log.exception("Failed to print task")
+        task = None
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--stdout', action='store_true')
+    parser.add_argument('--queue-size', type=int, default=app.config["PRINT_QUEUE_SIZE"])
     args = parser.parse_args()
-
-    Thread(target=print_loop, args=(args,)).start()
-    waitress.serve(app, port=8080)
+    logging.basicConfig(level=logging.INFO)
+    app.config["PRINT_QUEUE_SIZE"] = args.queue_size
+
+    # Daemon so that a print thread stuck reconnecting can't keep the
+    # process alive past the join timeout below
+    print_thread = Thread(target=print_loop, args=(args,), daemon=True)
+    print_thread.start()
+
+    server = waitress.create_server(app, port=8080)
+    # waitress's loop shuts down cleanly on SystemExit, so turn SIGTERM
+    # (e.g. systemctl stop/restart) into one
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("Serving on http://%s:%s", server.effective_host, server.effective_port)
+    server.run()
+    server.close()
+
+    # No new tasks can arrive now; let the printer finish what's queued
     print_queue.put(stop_sentinel)
+    stop_event.set()
+    print_thread.join(shutdown_timeout_seconds)
 
 
 if __name__ == "__main__":